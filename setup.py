@@ -13,7 +13,11 @@ setup(name='target-google-sheets',
           'jsonschema==2.6.0',
           'singer-python==1.5.0',
           'google-api-python-client==1.6.2',
-          'backoff==1.3.2'
+          'google-auth==1.6.3',
+          'google-auth-httplib2==0.0.3',
+          'backoff==1.3.2',
+          'orjson==3.8.3',
+          'ijson==3.1.4'
       ],
       entry_points='''
           [console_scripts]
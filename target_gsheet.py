@@ -1,38 +1,39 @@
 #!/usr/bin/env python3
 
 import argparse
-import functools
 import io
 import os
+import pathlib
 import sys
+import time
 import json
 import logging
-import collections
+from collections.abc import Mapping
+import queue
+import re
 import threading
-import http.client
-import urllib
-import pkg_resources
 import backoff
+import ijson
+import orjson
+from backoff import full_jitter
 
-from jsonschema import validate
+from jsonschema.validators import validator_for
 import singer
 
 import httplib2
 
-from apiclient import discovery
+from googleapiclient import discovery
 from googleapiclient.errors import HttpError
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
+from googleapiclient.http import set_user_agent
+from googleapiclient.model import JsonModel
+import google.oauth2.credentials
+import google_auth_httplib2
 
 
 # Read the config
-try:
-    parser = argparse.ArgumentParser(parents=[tools.argparser])
-    parser.add_argument('-c', '--config', help='Config file', required=True)
-    flags = parser.parse_args()
-except ImportError:
-    flags = None
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--config', help='Config file', required=True)
+flags = parser.parse_args()
 
 logging.getLogger('backoff').setLevel(logging.CRITICAL)
 logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
@@ -40,21 +41,95 @@ logger = singer.get_logger()
 
 MAX_RETRIES = 10
 
-def get_credentials(config):
-    """Gets valid user credentials from storage.
+# Google Sheets rejects any cell holding more characters than this
+CELL_MAX = 50000
+
+# Keep each append request well under the API's request body limit. A
+# retried append after a 5xx the server had in fact applied repeats up to
+# this many rows.
+BATCH_MAX_ROWS = 10000
+BATCH_MAX_BYTES = 5000000
+
+DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+DISCOVERY_CACHE = os.path.expanduser('~/.cache/target-google-sheets/sheets-v4.json')
+DISCOVERY_MAX_AGE = 86400
 
-    If nothing has been stored, or if the stored credentials are invalid,
-    the OAuth2 flow is completed to obtain the new credentials.
+# Set to parse input through singer.parse_message instead of orjson
+SINGER_PARSE = bool(os.environ.get('TARGET_GSHEET_SINGER_PARSE'))
+
+# orjson reads integers outside the 64-bit range as floats; any run of 19+
+# digits could be one, so such lines go through the stdlib parser instead
+WIDE_NUMBER = re.compile(rb'\d{19}')
+
+def get_credentials(config):
+    """Gets user credentials from the access token in the config.
 
     Returns:
         Credentials, the obtained credential.
     """
-    credentials = client.AccessTokenCredentials(config['access_token'], config.get("user-agent", 'target-google-sheets <hello@hotglue.xyz>'))
+    credentials = google.oauth2.credentials.Credentials(token=config['access_token'])
     return credentials
 
 
+def build_http(credentials, user_agent):
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+    return set_user_agent(http, user_agent)
+
+
+def to_json(value):
+    """Serializes to JSON bytes with orjson, or the stdlib for values it rejects."""
+    try:
+        return orjson.dumps(value)
+    except orjson.JSONEncodeError:
+        # same compact UTF-8 layout as orjson, so row_size holds for it too
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonModel(JsonModel):
+    """JsonModel that serializes request bodies with to_json.
+
+    Integers wider than 64 bits, which parse_message keeps exact, are
+    handed to the stdlib encoder there.
+    """
+
+    def serialize(self, body_value):
+        if self._data_wrapper:
+            return super().serialize(body_value)
+        return to_json(body_value)
+
+
+def get_discovery_document(http):
+    """Returns the Sheets v4 discovery document, cached on disk for a day.
+
+    The cache is best effort: when it can't be read or written the
+    document is fetched and used directly.
+    """
+    cache = pathlib.Path(DISCOVERY_CACHE)
+    try:
+        if time.time() - cache.stat().st_mtime <= DISCOVERY_MAX_AGE:
+            return cache.read_text(encoding='utf-8')
+    except OSError as exc:
+        logger.debug('Discovery cache not readable: %s', exc)
+
+    resp, content = http.request(DISCOVERY_URL)
+    if resp.status >= 400:
+        raise HttpError(resp, content, uri=DISCOVERY_URL)
+
+    # write then rename so concurrent runs never read a partial file
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache.with_name('{}.{}'.format(cache.name, os.getpid()))
+        tmp.write_bytes(content)
+        tmp.replace(cache)
+    except OSError as exc:
+        logger.debug('Discovery cache not writable: %s', exc)
+    return content.decode('utf-8')
+
+
 def giveup(exc):
-    return exc.resp is not None \
+    # connection resets and timeouts are always retried
+    return isinstance(exc, HttpError) \
+        and exc.resp is not None \
         and 400 <= int(exc.resp["status"]) < 500 \
         and int(exc.resp["status"]) != 429
 
@@ -63,21 +138,44 @@ def retry_handler(details):
     logger.info("Http unsuccessful request -- Retry %s/%s", details['tries'], MAX_RETRIES)
 
 
+_retryable = backoff.on_exception(backoff.expo,
+                                  (HttpError, ConnectionError, TimeoutError),
+                                  max_tries=MAX_RETRIES,
+                                  jitter=full_jitter,
+                                  base=2,
+                                  giveup=giveup,
+                                  on_backoff=retry_handler)
+
+# Appends are not idempotent: a write the server applied before the
+# connection dropped would be repeated in full, so only HTTP error
+# responses are retried for them
+_retryable_write = backoff.on_exception(backoff.expo,
+                                        HttpError,
+                                        max_tries=MAX_RETRIES,
+                                        jitter=full_jitter,
+                                        base=2,
+                                        giveup=giveup,
+                                        on_backoff=retry_handler)
+
+
 def emit_state(state):
     if state is not None:
-        line = json.dumps(state)
-        logger.debug('Emitting state {}'.format(line))
+        line = to_json(state).decode()
+        logger.debug('Emitting state %s', line)
         sys.stdout.write("{}\n".format(line))
         sys.stdout.flush()
         
+@_retryable
 def get_spreadsheet(service, spreadsheet_id):
     return service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
 
-def get_values(service, spreadsheet_id, range):
-    return service.spreadsheets().values().get(
-        spreadsheetId=spreadsheet_id, range=range).execute()
+@_retryable
+def batch_get_values(service, spreadsheet_id, ranges):
+    return service.spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id, ranges=ranges).execute()
 
-def add_sheet(service, spreadsheet_id, title):
+@_retryable
+def add_sheet(service, spreadsheet_id, title, col_count, row_count=1000):
     return service.spreadsheets().batchUpdate(
         spreadsheetId=spreadsheet_id,
         body={
@@ -87,93 +185,304 @@ def add_sheet(service, spreadsheet_id, title):
                     'properties': {
                         'title': title,
                         'gridProperties': {
-                            'rowCount': 1000,
-                            'columnCount': 26
+                            'rowCount': row_count,
+                            'columnCount': col_count,
+                            'frozenRowCount': 1
                         }
                     }
                     }
                 }
-            ]
+            ],
+            'includeSpreadsheetInResponse': True
         }).execute()
 
 
-@backoff.on_exception(backoff.expo,
-                      HttpError,
-                      max_tries=MAX_RETRIES,
-                      jitter=None,
-                      giveup=giveup,
-                      on_backoff=retry_handler)
-def append_to_sheet(service, spreadsheet_id, range, values):
+def create_sheet(service, spreadsheet_id, title, col_count):
+    """Adds a sheet and returns the refreshed spreadsheet.
+
+    addSheet isn't idempotent: when a retried call had already been
+    applied, the API answers 400 because the title exists. The sheet is
+    then there, so the spreadsheet is re-read instead of failing.
+    """
+    try:
+        return add_sheet(service, spreadsheet_id, title, col_count)['updatedSpreadsheet']
+    except HttpError as exc:
+        if exc.resp is None or int(exc.resp["status"]) != 400:
+            raise
+        spreadsheet = get_spreadsheet(service, spreadsheet_id)
+        if title not in {s['properties']['title'] for s in spreadsheet['sheets']}:
+            raise
+        return spreadsheet
+
+
+@_retryable_write
+def append_values(service, spreadsheet_id, range, values, http=None):
     return service.spreadsheets().values().append(
         spreadsheetId=spreadsheet_id,
         range=range,
         valueInputOption='USER_ENTERED',
-        body={'values': [values]}).execute()
+        body={'values': values}).execute(http=http)
+
+
+def bulk_update(service, spreadsheet_id, data, http=None):
+    # one append per sheet; rows on different sheets don't depend on each other
+    for title, values in data.items():
+        append_values(service, spreadsheet_id, append_range(title), values, http=http)
+
+
+def quote_title(title):
+    return "'{}'".format(title.replace("'", "''"))
+
+
+def header_range(title):
+    return "{}!1:1".format(quote_title(title))
+
+
+def append_range(title):
+    return "{}!A1:ZZZ".format(quote_title(title))
 
 
-def flatten(d, parent_key='', sep='__'):
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.MutableMapping):
-            items.extend(flatten(v, new_key, sep=sep).items())
+def get_headers(service, spreadsheet):
+    """Reads the first row of every existing grid sheet in a single request.
+
+    Chart sheets have no cells, and a range on one would fail the whole
+    batchGet, so only GRID sheets are read.
+
+    Returns:
+        dict of sheet title to header list, for sheets with a header row.
+    """
+    titles = [s['properties']['title'] for s in spreadsheet['sheets']
+              if s['properties'].get('sheetType', 'GRID') == 'GRID']
+    if not titles:
+        return {}
+
+    result = batch_get_values(service, spreadsheet['spreadsheetId'],
+                              [header_range(t) for t in titles])
+    return {title: value_range['values'][0]
+            for title, value_range in zip(titles, result.get('valueRanges', []))
+            if value_range.get('values')}
+
+
+def _scan(values):
+    """Stringifies non-scalar values once and flags any over CELL_MAX.
+
+    None and numbers can never exceed the cell limit, so they are passed
+    through without building a string.
+    """
+    out = []
+    over = False
+    for v in values:
+        if v is None or isinstance(v, (int, float)):
+            out.append(v)
+            continue
+        s = v if isinstance(v, str) else str(v)
+        out.append(s)
+        if len(s) > CELL_MAX:
+            over = True
+    return out, over
+
+
+def string_size(value):
+    """Returns the number of bytes a string takes in a JSON request body.
+
+    Printable ASCII only grows by the backslash escaping of quotes and
+    backslashes, which str.count handles in C. Anything else (UTF-8
+    multi-byte characters, \\uXXXX escaped control characters) is
+    measured by encoding it.
+    """
+    if value.isascii() and value.isprintable():
+        return len(value) + value.count('"') + value.count('\\') + 2
+    return len(orjson.dumps(value))
+
+
+def row_size(values):
+    """Estimates a row's serialized size in bytes.
+
+    Strings are counted exactly; every other cell gets a flat allowance
+    that covers numbers, booleans and null.
+    """
+    return sum(string_size(v) if v.__class__ is str else 24 for v in values) + len(values) + 1
+
+
+def queue_row(batch_updates, title, values):
+    # rows are grouped by sheet, keeping their order within each sheet
+    batch_updates.setdefault(title, []).append(values)
+    return row_size(values)
+
+
+def get_error_message(content):
+    """Pulls error.message out of an API error body.
+
+    The body of a failed append can echo a large part of the request,
+    so it is scanned as a stream rather than decoded in full.
+    """
+    try:
+        for prefix, event, value in ijson.parse(io.BytesIO(content)):
+            if prefix == 'error.message':
+                return value
+    except ijson.JSONError:
+        pass
+    return None
+
+
+def send_batches(service, spreadsheet_id, batches, errors, new_http):
+    """Writes batches taken from the queue until it yields None.
+
+    Runs on its own thread with its own Http, as httplib2 connections
+    can't be shared across threads. After a failure the queue is still
+    drained so the producer never blocks; the error is left in `errors`.
+    """
+    http = None
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        if errors:
+            continue
+        try:
+            if http is None:
+                http = new_http()
+            bulk_update(service, spreadsheet_id, batch, http=http)
+        except HttpError as exc:
+            logger.error("Unable to write batch: %s", get_error_message(exc.content))
+            errors.append(exc)
+        except Exception as exc:
+            errors.append(exc)
+
+
+def flatten(d, sep='__'):
+    # walk nested mappings with an explicit stack of iterators so keys come
+    # out in the same depth-first order as the record
+    flattened = {}
+    stack = [('', iter(d.items()))]
+    while stack:
+        parent_key, items = stack[-1]
+        prefix = parent_key + sep if parent_key else ''
+        for k, v in items:
+            new_key = prefix + k
+            if v.__class__ is dict or isinstance(v, Mapping):
+                stack.append((new_key, iter(v.items())))
+                break
+            flattened[new_key] = str(v) if type(v) is list else v
         else:
-            items.append((new_key, str(v) if type(v) is list else v))
-    return dict(items)
+            stack.pop()
+    return flattened
+
+
+def build_validator(schema):
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
 
 
-def persist_lines(service, spreadsheet, lines):
+def _iter_ndjson(buf, chunk_size=1 << 20):
+    """Yields newline-delimited lines from a binary stream as raw bytes."""
+    leftover = b''
+    while True:
+        chunk = buf.read(chunk_size)
+        if not chunk:
+            if leftover:
+                yield leftover
+            return
+        lines = (leftover + chunk).split(b'\n')
+        leftover = lines.pop()
+        yield from lines
+
+
+def parse_message(line):
+    if SINGER_PARSE:
+        return singer.parse_message(line).asdict()
+    if WIDE_NUMBER.search(line):
+        return json.loads(line)
+    return orjson.loads(line)
+
+
+def persist_lines(service, spreadsheet, lines, new_http):
     state = None
     schemas = {}
+    validators = {}
     key_properties = {}
 
-    headers_by_stream = {}
-    
-    for line in lines:
-        try:
-            msg = singer.parse_message(line)
-        except json.decoder.JSONDecodeError:
-            logger.error("Unable to parse:\n{}".format(line))
-            raise
-
-        if isinstance(msg, singer.RecordMessage):
-            if msg.stream not in schemas:
-                raise Exception("A record for stream {} was encountered before a corresponding schema".format(msg.stream))
-
-            schema = schemas[msg.stream]
-            validate(msg.record, schema)
-            flattened_record = flatten(msg.record)
-            
-            matching_sheet = [s for s in spreadsheet['sheets'] if s['properties']['title'] == msg.stream]
-            new_sheet_needed = len(matching_sheet) == 0
-            range_name = "{}!A1:ZZZ".format(msg.stream)
-            append = functools.partial(append_to_sheet, service, spreadsheet['spreadsheetId'], range_name)
-
-            if new_sheet_needed:
-                add_sheet(service, spreadsheet['spreadsheetId'], msg.stream)
-                spreadsheet = get_spreadsheet(service, spreadsheet['spreadsheetId']) # refresh this for future iterations
-                headers_by_stream[msg.stream] = list(flattened_record.keys())
-                append(headers_by_stream[msg.stream])
-
-            elif msg.stream not in headers_by_stream:
-                first_row = get_values(service, spreadsheet['spreadsheetId'], range_name + '1')
-                if 'values' in first_row:
-                    headers_by_stream[msg.stream] = first_row.get('values', None)[0]
-                else:
-                    headers_by_stream[msg.stream] = list(flattened_record.keys())
-                    append(headers_by_stream[msg.stream])
-
-            result = append([flattened_record.get(x, None) for x in headers_by_stream[msg.stream]]) # order by actual headers found in sheet
-
-            state = None
-        elif isinstance(msg, singer.StateMessage):
-            logger.debug('Setting state to {}'.format(msg.value))
-            state = msg.value
-        elif isinstance(msg, singer.SchemaMessage):
-            schemas[msg.stream] = msg.schema
-            key_properties[msg.stream] = msg.key_properties
-        else:
-            raise Exception("Unrecognized message {}".format(msg))
+    headers_by_stream = get_headers(service, spreadsheet)
+    sheet_titles = {s['properties']['title'] for s in spreadsheet['sheets']}
+    batch_updates = {}
+    pending_rows = 0
+    pending_bytes = 0
+
+    # full batches are written on a background thread while parsing
+    # continues; a single sender keeps appends in order
+    batches = queue.Queue(maxsize=4)
+    errors = []
+    sender = threading.Thread(target=send_batches,
+                              args=(service, spreadsheet['spreadsheetId'], batches, errors, new_http),
+                              daemon=True)
+    sender.start()
+
+    try:
+        for line in lines:
+            try:
+                msg = parse_message(line)
+            except json.decoder.JSONDecodeError:
+                logger.error("Unable to parse:\n{}".format(line.decode('utf-8', 'replace')))
+                raise
+
+            msg_type = msg.get('type')
+            if msg_type == 'RECORD':
+                stream = msg['stream']
+                if stream not in schemas:
+                    raise Exception("A record for stream {} was encountered before a corresponding schema".format(stream))
+
+                validators[stream].validate(msg['record'])
+                flattened_record = flatten(msg['record'])
+                
+                if stream not in headers_by_stream:
+                    headers_by_stream[stream] = list(flattened_record.keys())
+                    if stream not in sheet_titles:
+                        # sized to the header row so the first write needs no grid resize
+                        spreadsheet = create_sheet(service, spreadsheet['spreadsheetId'], stream,
+                                                   max(1, len(headers_by_stream[stream]))) # refresh this for future iterations
+                        sheet_titles.add(stream)
+                    pending_bytes += queue_row(batch_updates, stream, headers_by_stream[stream])
+                    pending_rows += 1
+
+                # order by actual headers found in sheet, catching cells the API
+                # would reject before they fail the whole batch
+                headers = headers_by_stream[stream]
+                row, oversized = _scan(map(flattened_record.get, headers))
+                if oversized:
+                    header = next(h for h, v in zip(headers, row) if isinstance(v, str) and len(v) > CELL_MAX)
+                    raise Exception("Value for {} in stream {} exceeds the {} character cell limit".format(header, stream, CELL_MAX))
+
+                pending_bytes += queue_row(batch_updates, stream, row)
+                pending_rows += 1
+
+                if pending_rows >= BATCH_MAX_ROWS or pending_bytes >= BATCH_MAX_BYTES:
+                    if errors:
+                        raise errors[0]
+                    batches.put(batch_updates)
+                    batch_updates = {}
+                    pending_rows = 0
+                    pending_bytes = 0
+
+                state = None
+            elif msg_type == 'STATE':
+                logger.debug('Setting state to %s', msg['value'])
+                state = msg['value']
+            elif msg_type == 'SCHEMA':
+                schemas[msg['stream']] = msg['schema']
+                validators[msg['stream']] = build_validator(msg['schema'])
+                key_properties[msg['stream']] = msg.get('key_properties')
+            else:
+                raise Exception("Unrecognized message {}".format(msg))
+
+        if batch_updates:
+            batches.put(batch_updates)
+    finally:
+        batches.put(None)
+        sender.join()
+
+    if errors:
+        raise errors[0]
 
     return state
 
@@ -185,18 +494,19 @@ def main():
 
     # Get the Google OAuth creds
     credentials = get_credentials(config)
-    http = credentials.authorize(httplib2.Http())
-    discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?'
-                    'version=v4')
-    service = discovery.build('sheets', 'v4', http=http,
-                              discoveryServiceUrl=discoveryUrl)
+    user_agent = config.get("user-agent", 'target-google-sheets <hello@hotglue.xyz>')
+    # one Http instance keeps its connection to sheets.googleapis.com open
+    # across every call made through the service
+    http = build_http(credentials, user_agent)
+    service = discovery.build_from_document(get_discovery_document(http), http=http,
+                                            model=OrjsonModel())
 
     # Get spreadsheet_id
     spreadsheet = get_spreadsheet(service, config['spreadsheet_id'])
 
-    input = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
     state = None
-    state = persist_lines(service, spreadsheet, input)
+    state = persist_lines(service, spreadsheet, _iter_ndjson(sys.stdin.buffer),
+                          lambda: build_http(credentials, user_agent))
     emit_state(state)
     logger.debug("Exiting normally")
 